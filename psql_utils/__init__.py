@@ -1,14 +1,39 @@
 import aiopg
-
-from functools import wraps
+import asyncio
+import hashlib
+import itertools
+import json
+import re
+import weakref
+
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from functools import lru_cache, wraps
+from psycopg2 import Error as PGError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
 from psycopg2.extras import DictCursor
 
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+
+def quote_ident(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
 
 class TableName(object):
+    __slots__ = ('table_name', 'alias_name', '_quoted')
 
     def __init__(self, table_name, alias=None):
         self.table_name = table_name
         self.alias_name = alias
+        if alias is None:
+            self._quoted = quote_ident(table_name)
+        else:
+            self._quoted = f'{quote_ident(table_name)} AS {alias}'
 
     def alias(self, alias):
         return TableName(self.table_name, alias)
@@ -16,14 +41,21 @@ class TableName(object):
     def __str__(self):
         return self.table_name
 
+    def __eq__(self, other):
+        if not isinstance(other, TableName):
+            return NotImplemented
+        return self.table_name == other.table_name and \
+            self.alias_name == other.alias_name
+
+    def __hash__(self):
+        return hash((self.table_name, self.alias_name))
+
 
 def get_table_name(table_name):
     if isinstance(table_name, list):
         return ', '.join([get_table_name(tn) for tn in table_name])
 
-    if table_name.alias_name is None:
-        return '"{}"'.format(table_name.table_name)
-    return '"{}" AS {}'.format(table_name.table_name, table_name.alias_name)
+    return table_name._quoted
 
 
 def t(table_name):
@@ -31,6 +63,7 @@ def t(table_name):
 
 
 class Column(object):
+    __slots__ = ('column', )
 
     def __init__(self, column):
         self.column = column
@@ -38,6 +71,14 @@ class Column(object):
     def __str__(self):
         return self.column
 
+    def __eq__(self, other):
+        if not isinstance(other, Column):
+            return NotImplemented
+        return self.column == other.column
+
+    def __hash__(self):
+        return hash(self.column)
+
 
 def c(column):
     return Column(column)
@@ -54,10 +95,14 @@ cs_all = cs(['*'])
 
 
 def columns_to_string(columns):
-    return ', '.join([str(x) for x in columns])
+    try:
+        return ', '.join([x.column for x in columns])
+    except AttributeError:
+        return ', '.join(map(str, columns))
 
 
 class IndexName(object):
+    __slots__ = ('index_name', )
 
     def __init__(self, index_name):
         self.index_name = index_name
@@ -65,13 +110,31 @@ class IndexName(object):
     def __str__(self):
         return self.index_name
 
+    def __eq__(self, other):
+        if not isinstance(other, IndexName):
+            return NotImplemented
+        return self.index_name == other.index_name
+
+    def __hash__(self):
+        return hash(self.index_name)
+
 
 def i(index_name):
     return IndexName(index_name)
 
 
+_placeholders = tuple([', '.join(['%s'] * x) for x in range(257)])
+
+
+def get_placeholders(size):
+    if size < 257:
+        return _placeholders[size]
+    return ', '.join(['%s'] * size)
+
+
 def get_index_name(table_name, index_name):
-    return '"{}_{}"'.format(table_name.table_name, index_name.index_name)
+    return quote_ident('{}_{}'.format(table_name.table_name,
+                                      index_name.index_name))
 
 
 def constraint_primary_key(table_name, columns):
@@ -79,7 +142,41 @@ def constraint_primary_key(table_name, columns):
         get_index_name(table_name, i('pk')), columns_to_string(columns)))
 
 
-_connector = None
+_sql_cache = {}
+_SQL_CACHE_MAX = 1024
+
+
+def get_table_key(table_name):
+    if isinstance(table_name, list):
+        return tuple([get_table_key(tn) for tn in table_name])
+
+    return (table_name.table_name, table_name.alias_name)
+
+
+def get_columns_key(columns):
+    return tuple([str(x) for x in columns])
+
+
+def get_cached_sql(key, gen, *args, cache=True):
+    if not cache:
+        return gen(*args)
+
+    # least recently used first, a hit moves the key back to the end
+    sql = _sql_cache.pop(key, None)
+    if sql is None:
+        sql = gen(*args)
+        if len(_sql_cache) >= _SQL_CACHE_MAX:
+            _sql_cache.pop(next(iter(_sql_cache)))
+    _sql_cache[key] = sql
+
+    return sql
+
+
+def is_reusable_join(join_sql):
+    # e.g. gen_ordering_sql writes the ids into the join, such one-off
+    # statements would only push the reusable ones out of the cache
+    return not join_sql or '%s' in join_sql or \
+        'VALUES' not in join_sql.upper()
 
 
 class PGConnnectorError(Exception):
@@ -87,8 +184,25 @@ class PGConnnectorError(Exception):
 
 
 class PGConnnector():
+    # errors raised when acquiring from a closing pool
+    closed_errors = (RuntimeError, )
 
     def __init__(self, config):
+        config = dict(config)
+        # prepare a query server side once it was executed this many times
+        # on a connection, None disables prepared statements
+        self.prepare_threshold = config.pop('prepare_threshold', None)
+        self.prepared_max = config.pop('prepared_max', 200)
+        # transaction pooling hands each statement to any server connection,
+        # so a statement prepared on one may be missing on the next
+        if config.pop('pgbouncer', False):
+            self.prepare_threshold = None
+        # keep a few connections open so the first requests don't pay
+        # for connect and auth, maxsize stays at aiopg's default of 10 and
+        # pool_recycle is handed to aiopg as is
+        maxsize = config.setdefault('maxsize', 10)
+        config.setdefault('minsize', min(4, maxsize) if maxsize else 4)
+        self.maxsize = maxsize
         self.config = config
         self.pool = None
 
@@ -106,24 +220,218 @@ class PGConnnector():
         return True
 
 
+re_returns_rows = re.compile(
+    r'^\s*(select|with|values|table|show|fetch|explain)\b|\breturning\b',
+    re.I)
+
+
+@lru_cache(maxsize=4096)
+def returns_rows(sql):
+    return re_returns_rows.search(sql) is not None
+
+
+class AsyncpgCursor(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+        self.rowcount = -1
+        self._rows = []
+        self._pos = 0
+
+    async def execute(self, sql, args=None):
+        if isinstance(sql, bytes):
+            sql = sql.decode()
+        if args:
+            sql = to_numbered_sql(sql)[0]
+        else:
+            args = ()
+
+        # fetch and execute go through the connection's statement cache,
+        # an explicit prepare() would parse the statement on every call
+        self._pos = 0
+        if returns_rows(sql):
+            self._rows = await self.connection.fetch(sql, *args)
+            self.rowcount = len(self._rows)
+            self.description = [(x, None) for x in self._rows[0].keys()
+                                ] if self._rows else None
+        else:
+            status = await self.connection.execute(sql, *args)
+            self._rows = []
+            self.description = None
+            status = status.rsplit(' ', 1)[-1]
+            self.rowcount = int(status) if status.isdigit() else -1
+
+    async def executemany(self, sql, rows):
+        await self.connection.executemany(
+            to_numbered_sql(sql)[0], [tuple(x) for x in rows])
+
+    async def fetchone(self):
+        if self._pos >= len(self._rows):
+            return None
+        self._pos += 1
+        return self._rows[self._pos - 1]
+
+    async def fetchmany(self, size):
+        ret = self._rows[self._pos:self._pos + size]
+        self._pos += len(ret)
+        return ret
+
+    async def fetchall(self):
+        ret = self._rows[self._pos:]
+        self._pos = len(self._rows)
+        return ret
+
+
+class AsyncpgConnection(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    @asynccontextmanager
+    async def cursor(self, cursor_factory=None):
+        # asyncpg records already allow access by index and by name,
+        # so every cursor factory maps to the same cursor
+        yield AsyncpgCursor(self.connection)
+
+
+class AsyncpgPool(object):
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._close_task = None
+
+    @property
+    def closed(self):
+        return self.pool.is_closing()
+
+    @asynccontextmanager
+    async def acquire(self):
+        async with self.pool.acquire() as conn:
+            yield AsyncpgConnection(conn)
+
+    def close(self):
+        if self._close_task is None:
+            self._close_task = asyncio.ensure_future(self.pool.close())
+
+    async def wait_closed(self):
+        if self._close_task is not None:
+            await self._close_task
+
+
+def encode_json(val):
+    # callers pass json columns already dumped, like they do for psycopg2
+    if isinstance(val, str):
+        return val
+    return json.dumps(val)
+
+
+class AsyncpgConnector(PGConnnector):
+    # asyncpg raises InterfaceError instead of RuntimeError for a closed pool
+    closed_errors = (RuntimeError, asyncpg.InterfaceError) \
+        if asyncpg else (RuntimeError, )
+
+    def __init__(self, config):
+        config = dict(config)
+        # size the pool with the aiopg defaults unless asyncpg keys are set
+        if 'min_size' in config:
+            config['minsize'] = config.pop('min_size')
+        if 'max_size' in config:
+            config['maxsize'] = config.pop('max_size')
+        super().__init__(config)
+        # asyncpg keeps a per-connection cache of the statements run by
+        # fetch and execute, behind pgbouncer it has to be turned off
+        cache_size = 0 if config.get('pgbouncer') else self.prepared_max
+        self.config.setdefault('statement_cache_size', cache_size)
+        self.prepare_threshold = None
+        self.config['min_size'] = self.config.pop('minsize')
+        self.config['max_size'] = self.config.pop('maxsize')
+        self.init = self.config.pop('init', None)
+        self.config['init'] = self.init_connection
+
+    async def init_connection(self, conn):
+        # asyncpg returns json and jsonb as text by default, decode them
+        # the way psycopg2 does so record.save can merge old values
+        for name in ('json', 'jsonb'):
+            await conn.set_type_codec(name,
+                                      schema='pg_catalog',
+                                      encoder=encode_json,
+                                      decoder=json.loads)
+        if self.init is not None:
+            await self.init(conn)
+
+    async def connect(self):
+        if asyncpg is None:
+            raise PGConnnectorError('asyncpg is not installed')
+
+        if self.pool is not None:
+            self.pool.close()
+
+        self.pool = AsyncpgPool(await asyncpg.create_pool(**self.config))
+
+        return True
+
+
+_connectors = {
+    'aiopg': PGConnnector,
+    'asyncpg': AsyncpgConnector,
+}
+
+
+@dataclass
+class _State:
+    connector: PGConnnector = None
+    events: list = field(default_factory=list)
+    insert_buffers: dict = field(default_factory=dict)
+    flush_task: asyncio.Future = None
+    flush_error: Exception = None
+
+
+_state_var = ContextVar('psql_utils_state', default=_State())
+
+
+@contextmanager
+def scoped_state():
+    # a separate connector and insert_async buffer for the block, e.g. one
+    # per test or tenant, on_connected handlers registered so far carry
+    # over, connect inside and close before leaving:
+    # with scoped_state():
+    #     await connect(config)
+    #     ...
+    #     await close()
+    state = _State(events=list(_state_var.get().events))
+    token = _state_var.set(state)
+    try:
+        yield state
+    finally:
+        _state_var.reset(token)
+
+
 def get_connector():
-    return _connector
+    return _state_var.get().connector
 
 
-_connected_events = []
+def require_connector():
+    connector = _state_var.get().connector
+    if connector is None:
+        raise PGConnnectorError('not connected')
+    return connector
 
 
 def on_connected(func):
-    global _connected_events
-    _connected_events.append(func)
+    _state_var.get().events.append(func)
 
 
 async def connect(config):
-    global _connector
-    _connector = PGConnnector(config)
-
-    if await _connector.connect():
-        for evt in _connected_events:
+    state = _state_var.get()
+    config = dict(config)
+    driver = config.pop('driver', 'aiopg')
+    state.connector = _connectors[driver](config)
+
+    if await state.connector.connect():
+        # run in registration order, later events may rely on earlier
+        # ones, e.g. create_index after create_table
+        for evt in state.events:
             await evt()
         return True
 
@@ -131,11 +439,21 @@ async def connect(config):
 
 
 async def close():
-    if not _connector:
+    connector = _state_var.get().connector
+    if connector is None:
         return
-    pool = _connector.get()
-    pool.close()
-    await pool.wait_closed()
+    try:
+        await flush_inserts()
+    finally:
+        pool = connector.get()
+        pool.close()
+        await pool.wait_closed()
+
+
+def is_pool_closing(pool):
+    # aiopg only flags the pool closed once wait_closed is done, but
+    # refuses connections as soon as close was called
+    return pool.closed or getattr(pool, '_closing', False)
 
 
 def run_with_pool(cursor_factory=None):
@@ -144,57 +462,93 @@ def run_with_pool(cursor_factory=None):
 
         @wraps(f)
         async def run(*args, cur=None, **kwargs):
-            if _connector is None:
-                raise PGConnnectorError('not connected')
-
-            try:
-                if cur is None:
-                    async with _connector.get().acquire() as conn:
-                        async with conn.cursor(
-                                cursor_factory=cursor_factory) as cur0:
-                            return await f(cur0, *args, **kwargs)
-                else:
-                    return await f(cur, *args, **kwargs)
-            except RuntimeError as e:
-                if cur:
-                    raise e
-
-                err = str(e)
-                if err.find('closing') > -1:
-                    connected = await _connector.connect()
-                    if connected:
-                        return await run(*args, **kwargs)
-                    else:
-                        raise e
-                else:
-                    raise e
+            if cur is not None:
+                return await f(cur, *args, **kwargs)
+
+            connector = require_connector()
+
+            for retry in range(2):
+                pool = connector.get()
+                try:
+                    async with pool.acquire() as conn, \
+                            conn.cursor(cursor_factory=cursor_factory) as cur0:
+                        return await f(cur0, *args, **kwargs)
+                except connector.closed_errors:
+                    # the pool refuses to hand out connections once it
+                    # is closing, reconnect once and try again
+                    if retry > 0 or not is_pool_closing(pool) or \
+                            not await connector.connect():
+                        raise
 
         return run
 
     return decorator
 
 
+@asynccontextmanager
+async def acquire_cursor(cursor_factory=DictCursor):
+    async with require_connector().get().acquire() as conn:
+        async with conn.cursor(cursor_factory=cursor_factory) as cur:
+            yield cur
+
+
+async def gather_queries(*coros, limit=None):
+    # every call checks out its own pool connection, so independent
+    # queries run side by side, e.g.
+    # users, total = await gather_queries(select(...), count(...))
+    # at most limit run at once, the pool size by default, the rest start
+    # as connections free up. the first failure cancels the rest and the
+    # queries not started yet are never sent
+    if limit is None:
+        connector = get_connector()
+        limit = connector.maxsize if connector else 0
+    sem = asyncio.Semaphore(limit or len(coros) or 1)
+
+    async def run(coro):
+        try:
+            async with sem:
+                return await coro
+        finally:
+            coro.close()
+
+    tasks = [asyncio.ensure_future(run(coro)) for coro in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+async def batch(funcs, cursor_factory=None):
+    # run several helpers on one checked out connection, e.g.
+    # await batch([partial(create_table, t, cols),
+    #              partial(create_index, False, t, i('idx'), cols)])
+    async with acquire_cursor(cursor_factory=cursor_factory) as cur:
+        return [await func(cur=cur) for func in funcs]
+
+
 @run_with_pool()
 async def create_table(cur, table_name, columns):
     await fixed_execute(
-        cur, 'CREATE TABLE IF NOT EXISTS {} ({})'.format(
-            get_table_name(table_name), columns_to_string(columns)))
+        cur, f'CREATE TABLE IF NOT EXISTS {get_table_name(table_name)} '
+        f'({columns_to_string(columns)})')
 
 
 @run_with_pool()
 async def add_table_column(cur, table_name, columns):
     await fixed_execute(
-        cur, 'ALTER TABLE {} ADD COLUMN {}'.format(get_table_name(table_name),
-                                                   columns_to_string(columns)))
+        cur, f'ALTER TABLE {get_table_name(table_name)} '
+        f'ADD COLUMN {columns_to_string(columns)}')
 
 
 @run_with_pool()
 async def create_index(cur, uniq, table_name, index_name, columns):
     uniq_word = 'UNIQUE ' if uniq else ''
+    index = get_index_name(table_name, index_name)
     await fixed_execute(
-        cur, 'CREATE {}INDEX IF NOT EXISTS {} ON {} ({})'.format(
-            uniq_word, get_index_name(table_name, index_name),
-            get_table_name(table_name), columns_to_string(columns)))
+        cur, f'CREATE {uniq_word}INDEX IF NOT EXISTS {index} '
+        f'ON {get_table_name(table_name)} ({columns_to_string(columns)})')
 
 
 async def get_only_default(cur, default):
@@ -207,6 +561,13 @@ async def get_only_default(cur, default):
         return default
 
 
+def gen_insert(table_name, columns, ret_column=None):
+    ret_sql = f' returning {ret_column}' if ret_column else ''
+    return f'INSERT INTO {get_table_name(table_name)} ' \
+        f'({columns_to_string(columns)}) ' \
+        f'VALUES ({get_placeholders(len(columns))}){ret_sql}'
+
+
 @run_with_pool()
 async def insert(cur,
                  table_name,
@@ -214,68 +575,327 @@ async def insert(cur,
                  args,
                  ret_column=None,
                  ret_def=None):
-    v = [Column('%s') for x in columns]
-    ret_sql = ' returning {}'.format(ret_column) if ret_column else ''
-    await fixed_execute(
-        cur,
-        'INSERT INTO {} ({}) VALUES ({}){}'.format(get_table_name(table_name),
-                                                   columns_to_string(columns),
-                                                   columns_to_string(v),
-                                                   ret_sql), args)
+    key = ('insert', get_table_key(table_name), get_columns_key(columns),
+           str(ret_column) if ret_column else None)
+    sql = get_cached_sql(key, gen_insert, table_name, columns, ret_column)
+    await fixed_execute(cur, sql, args)
 
     if ret_column:
         return await get_only_default(cur, ret_def)
 
 
+def make_insert(table_name, columns, ret_column=None, ret_def=None):
+    sql = gen_insert(table_name, columns, ret_column)
+
+    @run_with_pool()
+    async def run(cur, args):
+        await fixed_execute(cur, sql, args)
+
+        if ret_column:
+            return await get_only_default(cur, ret_def)
+
+    return run
+
+
+def gen_insert_many(table_name,
+                    columns,
+                    size,
+                    ret_column=None,
+                    conflict_sql=''):
+    v = f'({get_placeholders(len(columns))})'
+    values_sql = ', '.join([v] * size)
+    ret_sql = f' returning {get_returning(ret_column)}' if ret_column else ''
+    return f'INSERT INTO {get_table_name(table_name)} ' \
+        f'({columns_to_string(columns)}) ' \
+        f'VALUES {values_sql}{conflict_sql}{ret_sql}'
+
+
+def get_returning(ret_column):
+    # a list of columns returns whole rows instead of single values
+    if isinstance(ret_column, list):
+        return columns_to_string(ret_column)
+    return str(ret_column)
+
+
+def get_returned(ret_column, rows):
+    # rows come back in the server's order, postgres doesn't promise the
+    # VALUES order
+    if isinstance(ret_column, list):
+        return [tuple(x) for x in rows]
+    return [x[0] for x in rows]
+
+
+async def execute_many_pages(cur, gen, rows, page_size, fetch=False):
+    ret = []
+    args = []
+    size = 0
+    for row in rows:
+        args.extend(row)
+        size += 1
+        if size >= page_size:
+            await fixed_execute(cur, gen(size), args)
+            if fetch:
+                ret.extend(await cur.fetchall())
+            args = []
+            size = 0
+
+    if size > 0:
+        await fixed_execute(cur, gen(size), args)
+        if fetch:
+            ret.extend(await cur.fetchall())
+
+    return ret
+
+
+@run_with_pool()
+async def insert_many(cur,
+                      table_name,
+                      columns,
+                      rows,
+                      page_size=1000,
+                      ret_column=None):
+
+    key = ('insert_many', get_table_key(table_name), get_columns_key(columns),
+           get_returning(ret_column) if ret_column else None)
+
+    def gen(size):
+        # only full pages repeat, the short last page is built as is
+        if size != page_size:
+            return gen_insert_many(table_name, columns, size, ret_column)
+        return get_cached_sql(key + (size, ), gen_insert_many, table_name,
+                              columns, size, ret_column)
+
+    ret = await execute_many_pages(cur, gen, rows, page_size,
+                                   ret_column is not None)
+    if ret_column:
+        return get_returned(ret_column, ret)
+
+
+ASYNC_INSERT_MAX_ROWS = 100000
+ASYNC_INSERT_WAIT_TIME = 0.2
+
+
+class InsertFlushError(Exception):
+
+    def __init__(self, table_name, columns, rows):
+        super().__init__(
+            f'failed to insert {len(rows)} buffered rows into {table_name}')
+        # the rows are handed back so the caller can retry or inspect them
+        self.table_name = table_name
+        self.columns = columns
+        self.rows = rows
+
+
+async def flush_inserts():
+    state = _state_var.get()
+    buffers = state.insert_buffers
+    while buffers:
+        key = next(iter(buffers))
+        table_name, columns, rows = buffers.pop(key)
+        try:
+            await insert_many(table_name, columns, rows)
+        except Exception as e:
+            raise InsertFlushError(table_name, columns, rows) from e
+
+    error, state.flush_error = state.flush_error, None
+    if error is not None:
+        raise error
+
+
+async def _flusher(wait_time):
+    state = _state_var.get()
+    await asyncio.sleep(wait_time)
+    # an earlier failure has to reach a caller before flushing more
+    if state.flush_error is not None:
+        return
+    try:
+        await flush_inserts()
+    except InsertFlushError as e:
+        # nobody awaits this task, raise it on the next insert_async,
+        # flush_inserts or close
+        state.flush_error = e
+
+
+async def insert_async(table_name, columns, row):
+    state = _state_var.get()
+    if state.flush_error is not None:
+        error, state.flush_error = state.flush_error, None
+        raise error
+
+    key = (get_table_key(table_name), get_columns_key(columns))
+    buf = state.insert_buffers.get(key)
+    if buf is None:
+        buf = (table_name, columns, [])
+        state.insert_buffers[key] = buf
+
+    buf[2].append(row)
+
+    if len(buf[2]) >= ASYNC_INSERT_MAX_ROWS:
+        await flush_inserts()
+    elif state.flush_task is None or state.flush_task.done():
+        state.flush_task = asyncio.ensure_future(
+            _flusher(ASYNC_INSERT_WAIT_TIME))
+
+
 def append_excluded_set(column):
     col = str(column)
-    if col.find('=') > -1:
+    if '=' in col:
         return col
-    return "{} = excluded.{}".format(col, col)
+    return f'{col} = excluded.{col}'
+
+
+def gen_on_conflict(uniq_columns, value_columns):
+    set_sql = ', '.join([append_excluded_set(x) for x in value_columns])
+    do_sql = f' DO UPDATE SET {set_sql}' if value_columns else ' DO NOTHING'
+    return f' ON CONFLICT ({columns_to_string(uniq_columns)}) {do_sql}'
+
+
+def gen_insert_or_update(table_name,
+                         uniq_columns,
+                         value_columns,
+                         other_columns,
+                         ret_column=None):
+    cols = uniq_columns + value_columns + other_columns
+    conflict_sql = gen_on_conflict(uniq_columns, value_columns)
+    ret_sql = f' returning {ret_column}' if ret_column else ''
+    return f'INSERT INTO {get_table_name(table_name)} ' \
+        f'({columns_to_string(cols)}) ' \
+        f'VALUES ({get_placeholders(len(cols))}){conflict_sql}{ret_sql}'
 
 
 @run_with_pool()
 async def insert_or_update(cur,
                            table_name,
                            uniq_columns,
-                           value_columns=[],
-                           other_columns=[],
-                           args=()):
-    cols = uniq_columns + value_columns + other_columns
-    v = [Column('%s') for x in cols]
-    set_sql = ', '.join([append_excluded_set(x) for x in value_columns])
-    do_sql = " DO UPDATE SET {}".format(
-        set_sql) if value_columns else " DO NOTHING"
-    sql = "INSERT INTO {} ({}) VALUES ({}) ON CONFLICT ({}) {}".format(
-        get_table_name(table_name), columns_to_string(cols),
-        columns_to_string(v), columns_to_string(uniq_columns), do_sql)
+                           value_columns=None,
+                           other_columns=None,
+                           args=(),
+                           ret_column=None,
+                           ret_def=None):
+    value_columns = value_columns or []
+    other_columns = other_columns or []
+    key = ('insert_or_update', get_table_key(table_name),
+           get_columns_key(uniq_columns), get_columns_key(value_columns),
+           get_columns_key(other_columns),
+           str(ret_column) if ret_column else None)
+    sql = get_cached_sql(key, gen_insert_or_update, table_name, uniq_columns,
+                         value_columns, other_columns, ret_column)
 
     await fixed_execute(cur, sql, args)
 
+    if ret_column:
+        return await get_only_default(cur, ret_def)
+
+
+@run_with_pool()
+async def insert_or_update_many(cur,
+                                table_name,
+                                uniq_columns,
+                                value_columns=None,
+                                other_columns=None,
+                                rows=(),
+                                page_size=1000,
+                                ret_column=None):
+    # a page must not hold the same unique key twice, postgres refuses to
+    # update one row twice in a single statement
+    value_columns = value_columns or []
+    other_columns = other_columns or []
+    cols = uniq_columns + value_columns + other_columns
+    conflict_sql = gen_on_conflict(uniq_columns, value_columns)
+    key = ('insert_many', get_table_key(table_name), get_columns_key(cols),
+           get_returning(ret_column) if ret_column else None, conflict_sql)
+
+    def gen(size):
+        if size != page_size:
+            return gen_insert_many(table_name, cols, size, ret_column,
+                                   conflict_sql)
+        return get_cached_sql(key + (size, ), gen_insert_many, table_name,
+                              cols, size, ret_column, conflict_sql)
+
+    ret = await execute_many_pages(cur, gen, rows, page_size,
+                                   ret_column is not None)
+    if ret_column:
+        return get_returned(ret_column, ret)
+
 
 def append_update_set(column):
     col = str(column)
-    if col.find('=') > -1:
+    if '=' in col:
         return col
-    return "{} = %s".format(col)
+    return f'{col} = %s'
+
+
+def gen_update(table_name, columns, part_sql=''):
+    set_sql = ', '.join([append_update_set(x) for x in columns])
+    where_sql = f' WHERE {part_sql}' if part_sql else ''
+    return f'UPDATE {get_table_name(table_name)} SET {set_sql}{where_sql}'
 
 
 @run_with_pool()
 async def update(cur, table_name, columns, part_sql="", args=()):
-    set_sql = ', '.join([append_update_set(x) for x in columns])
-    where_sql = ' WHERE {}'.format(part_sql) if part_sql else ''
-    sql = "UPDATE {} SET {}{}".format(get_table_name(table_name), set_sql,
-                                      where_sql)
+    key = ('update', get_table_key(table_name), get_columns_key(columns),
+           part_sql)
+    sql = get_cached_sql(key, gen_update, table_name, columns, part_sql)
     await fixed_execute(cur, sql, args)
+    return cur.rowcount
+
+
+def gen_delete(table_name, part_sql=''):
+    where_sql = f' WHERE {part_sql}' if part_sql else ''
+    return f'DELETE FROM {get_table_name(table_name)}{where_sql}'
 
 
 @run_with_pool()
 async def delete(cur, table_name, part_sql="", args=()):
-    where_sql = ' WHERE {}'.format(part_sql) if part_sql else ''
-    sql = 'DELETE FROM {}{}'.format(get_table_name(table_name), where_sql)
+    key = ('delete', get_table_key(table_name), part_sql)
+    sql = get_cached_sql(key, gen_delete, table_name, part_sql)
     await fixed_execute(cur, sql, args)
 
 
+async def execute_batch(cur, sql, rows, page_size):
+    if isinstance(cur, AsyncpgCursor):
+        return await cur.executemany(sql, rows)
+
+    # aiopg has no executemany, send a page of bound statements in one
+    # query string instead, postgres runs it as a single transaction
+    page = []
+    for args in rows:
+        page.append(cur.mogrify(sql, args))
+        if len(page) >= page_size:
+            await cur.execute(b'; '.join(page))
+            page = []
+
+    if page:
+        await cur.execute(b'; '.join(page))
+
+
+@run_with_pool()
+async def update_many(cur,
+                      table_name,
+                      columns,
+                      part_sql='',
+                      rows=(),
+                      page_size=100):
+    key = ('update', get_table_key(table_name), get_columns_key(columns),
+           part_sql)
+    sql = get_cached_sql(key, gen_update, table_name, columns, part_sql)
+    await execute_batch(cur, sql, rows, page_size)
+
+
+@run_with_pool()
+async def delete_many(cur, table_name, part_sql='', rows=(), page_size=100):
+    key = ('delete', get_table_key(table_name), part_sql)
+    sql = get_cached_sql(key, gen_delete, table_name, part_sql)
+    await execute_batch(cur, sql, rows, page_size)
+
+
+def gen_sum(table_name, part_sql='', column=c('*'), join_sql=''):
+    where_sql = f' WHERE {part_sql}' if part_sql else ''
+    join_sql = f' {join_sql} ' if join_sql else ''
+    return f'SELECT sum({column}) FROM {get_table_name(table_name)}' \
+        f'{join_sql}{where_sql}'
+
+
 @run_with_pool()
 async def sum(cur,
               table_name,
@@ -283,15 +903,24 @@ async def sum(cur,
               args=(),
               column=c('*'),
               join_sql=''):
-    where_sql = ' WHERE {}'.format(part_sql) if part_sql else ''
-    join_sql = ' {} '.format(join_sql) if join_sql else ''
-    sql = 'SELECT sum({}) FROM {}{}{}'.format(str(column),
-                                              get_table_name(table_name),
-                                              join_sql, where_sql)
+    key = ('sum', get_table_key(table_name), part_sql, str(column), join_sql)
+    sql = get_cached_sql(key, gen_sum, table_name, part_sql, column, join_sql,
+                         cache=is_reusable_join(join_sql))
     await fixed_execute(cur, sql, args)
     return await get_only_default(cur, 0)
 
 
+def gen_count(table_name,
+              part_sql='',
+              column=c('*'),
+              join_sql='',
+              other_sql=''):
+    where_sql = f' WHERE {part_sql}' if part_sql else ''
+    join_sql = f' {join_sql} ' if join_sql else ''
+    return f'SELECT count({column}) FROM {get_table_name(table_name)}' \
+        f'{join_sql}{where_sql} {other_sql}'
+
+
 @run_with_pool()
 async def count(cur,
                 table_name,
@@ -300,17 +929,70 @@ async def count(cur,
                 column=c('*'),
                 join_sql='',
                 other_sql=''):
-    where_sql = ' WHERE {}'.format(part_sql) if part_sql else ''
-    join_sql = ' {} '.format(join_sql) if join_sql else ''
-    sql = 'SELECT count({}) FROM {}{}{} {}'.format(str(column),
-                                                   get_table_name(table_name),
-                                                   join_sql, where_sql,
-                                                   other_sql)
+    key = ('count', get_table_key(table_name), part_sql, str(column),
+           join_sql, other_sql)
+    sql = get_cached_sql(key, gen_count, table_name, part_sql, column,
+                         join_sql, other_sql,
+                         cache=is_reusable_join(join_sql))
     await fixed_execute(cur, sql, args)
     return await get_only_default(cur, 0)
 
 
-@run_with_pool(cursor_factory=DictCursor)
+def gen_select(table_name,
+               columns,
+               part_sql='',
+               offset=None,
+               size=None,
+               other_sql='',
+               join_sql=''):
+    where_sql = f' WHERE {part_sql}' if part_sql else ''
+    join_sql = f' {join_sql} ' if join_sql else ''
+    limit_sql = '' if size is None else f' LIMIT {size}'
+    offset_sql = '' if offset is None else f' OFFSET {offset}'
+    return f'SELECT {columns_to_string(columns)} ' \
+        f'FROM {get_table_name(table_name)}{join_sql}{where_sql} ' \
+        f'{other_sql}{limit_sql}{offset_sql}'
+
+
+def get_select_sql(table_name, columns, part_sql, offset, size, other_sql,
+                   join_sql):
+    key = ('select', get_table_key(table_name), get_columns_key(columns),
+           part_sql, offset, size, other_sql, join_sql)
+    # a literal offset changes with every page, only a bound one repeats
+    cache = offset in (None, '%s') and is_reusable_join(join_sql)
+    return get_cached_sql(key, gen_select, table_name, columns, part_sql,
+                          offset, size, other_sql, join_sql, cache=cache)
+
+
+def get_paged_select_sql(table_name, columns, part_sql, args, offset, size,
+                         other_sql, join_sql):
+    # bind LIMIT and OFFSET so every page shares one cached (and possibly
+    # prepared) statement, only possible when args are already positional
+    if not args or not isinstance(args, (tuple, list)) or \
+            (offset is None and size is None):
+        return get_select_sql(table_name, columns, part_sql, offset, size,
+                              other_sql, join_sql), args
+
+    args = list(args)
+    if size is not None:
+        args.append(size)
+        size = '%s'
+    if offset is not None:
+        args.append(offset)
+        offset = '%s'
+
+    return get_select_sql(table_name, columns, part_sql, offset, size,
+                          other_sql, join_sql), args
+
+
+def rows_to_dicts(cur, rows):
+    if not rows or isinstance(rows[0], dict):
+        return rows
+    keys = [x[0] for x in cur.description]
+    return [dict(zip(keys, x)) for x in rows]
+
+
+@run_with_pool()
 async def select(cur,
                  table_name,
                  columns,
@@ -319,21 +1001,88 @@ async def select(cur,
                  offset=None,
                  size=None,
                  other_sql="",
-                 join_sql=''):
-    where_sql = ' WHERE {}'.format(part_sql) if part_sql else ''
-    join_sql = ' {} '.format(join_sql) if join_sql else ''
-    limit_sql = '' if size is None else ' LIMIT {}'.format(size)
-    offset_sql = '' if offset is None else ' OFFSET {}'.format(offset)
-    sql = "SELECT {} FROM {}{}{} {}{}{}".format(columns_to_string(columns),
-                                                get_table_name(table_name),
-                                                join_sql, where_sql, other_sql,
-                                                limit_sql, offset_sql)
+                 join_sql='',
+                 as_dict=True):
+    sql, args = get_paged_select_sql(table_name, columns, part_sql, args,
+                                     offset, size, other_sql, join_sql)
     await fixed_execute(cur, sql, args)
     ret = await cur.fetchall()
-    return [dict(x) for x in ret]
+    if as_dict:
+        return rows_to_dicts(cur, ret)
+    return ret
+
+
+@run_with_pool()
+async def select_columns(cur,
+                         table_name,
+                         columns,
+                         part_sql='',
+                         args=(),
+                         offset=None,
+                         size=None,
+                         other_sql='',
+                         join_sql=''):
+    sql, args = get_paged_select_sql(table_name, columns, part_sql, args,
+                                     offset, size, other_sql, join_sql)
+    await fixed_execute(cur, sql, args)
+    ret = await cur.fetchall()
+    if not ret:
+        # asyncpg only describes a result through its rows
+        return tuple([[] for x in cur.description or columns])
+    return tuple([list(x) for x in zip(*ret)])
+
+
+_stream_names = itertools.count(1)
+
+
+async def select_stream(table_name,
+                        columns,
+                        part_sql='',
+                        args=(),
+                        other_sql='',
+                        join_sql='',
+                        chunk_size=1000,
+                        as_dict=True):
+    # aiopg connections are asynchronous and can't open named cursors,
+    # so declare a server side cursor by hand and fetch it in chunks.
+    # the connection stays checked out in an open transaction until the
+    # generator finishes or is closed, a caller that may stop early has
+    # to close it, e.g. with contextlib.aclosing()
+    sql = get_select_sql(table_name, columns, part_sql, None, None,
+                         other_sql, join_sql)
+    name = 'psql_utils_stream_{}'.format(next(_stream_names))
+    declare_sql = 'DECLARE {} NO SCROLL CURSOR FOR {}'.format(name, sql)
+    fetch_sql = 'FETCH {} FROM {}'.format(chunk_size, name)
+
+    async with acquire_cursor(cursor_factory=None) as cur:
+        await cur.execute('BEGIN')
+        try:
+            if args:
+                await cur.execute(declare_sql, args)
+            else:
+                await cur.execute(declare_sql)
 
+            while True:
+                await cur.execute(fetch_sql)
+                rows = await cur.fetchall()
+                if not rows:
+                    break
 
-async def select_only(table_name,
+                if as_dict:
+                    rows = rows_to_dicts(cur, rows)
+
+                for row in rows:
+                    yield row
+
+                if len(rows) < chunk_size:
+                    break
+        finally:
+            await cur.execute('ROLLBACK')
+
+
+@run_with_pool()
+async def select_only(cur,
+                      table_name,
                       column,
                       part_sql='',
                       args=(),
@@ -341,46 +1090,61 @@ async def select_only(table_name,
                       size=None,
                       other_sql='',
                       join_sql=''):
-    ret = await select(table_name, [column], part_sql, args, offset, size,
-                       other_sql, join_sql)
-    return [list(x.values())[0] for x in ret]
+    sql, args = get_paged_select_sql(table_name, [column], part_sql, args,
+                                     offset, size, other_sql, join_sql)
+    await fixed_execute(cur, sql, args)
+    ret = await cur.fetchall()
+    return [x[0] for x in ret]
+
+
+def gen_select_one(table_name, columns, part_sql='', join_sql=''):
+    where_sql = f' WHERE {part_sql}' if part_sql else ''
+    join_sql = f' {join_sql} ' if join_sql else ''
+    return f'SELECT {columns_to_string(columns)} ' \
+        f'FROM {get_table_name(table_name)}{join_sql}{where_sql} LIMIT 1'
 
 
-@run_with_pool(cursor_factory=DictCursor)
+@run_with_pool()
 async def select_one(cur,
                      table_name,
                      columns,
                      part_sql='',
                      args=(),
-                     join_sql=''):
-    where_sql = ' WHERE {}'.format(part_sql) if part_sql else ''
-    join_sql = ' {} '.format(join_sql) if join_sql else ''
-    sql = "SELECT {} FROM {}{}{} LIMIT 1".format(columns_to_string(columns),
-                                                 get_table_name(table_name),
-                                                 join_sql, where_sql)
+                     join_sql='',
+                     as_dict=True):
+    key = ('select_one', get_table_key(table_name), get_columns_key(columns),
+           part_sql, join_sql)
+    sql = get_cached_sql(key, gen_select_one, table_name, columns, part_sql,
+                         join_sql, cache=is_reusable_join(join_sql))
     await fixed_execute(cur, sql, args)
     ret = await cur.fetchone()
-    if ret:
-        return dict(ret)
-    return None
+    if ret is None or not as_dict or isinstance(ret, dict):
+        return ret
+    return dict(zip([x[0] for x in cur.description], ret))
 
 
-async def select_one_only(table_name,
+@run_with_pool()
+async def select_one_only(cur,
+                          table_name,
                           column,
                           part_sql='',
                           args=(),
                           join_sql=''):
-    ret = await select_one(table_name, [column], part_sql, args, join_sql)
+    key = ('select_one', get_table_key(table_name), get_columns_key([column]),
+           part_sql, join_sql)
+    sql = get_cached_sql(key, gen_select_one, table_name, [column], part_sql,
+                         join_sql, cache=is_reusable_join(join_sql))
+    await fixed_execute(cur, sql, args)
+    ret = await cur.fetchone()
     if ret:
-        return list(ret.values())[0]
+        return ret[0]
 
     return None
 
 
 @run_with_pool()
 async def drop_table(cur, table_name):
-    await fixed_execute(cur,
-                        'drop table {}'.format(get_table_name(table_name)))
+    await fixed_execute(cur, f'drop table {get_table_name(table_name)}')
 
 
 def gen_ordering_sql(column, arr):
@@ -392,6 +1156,30 @@ def gen_ordering_sql(column, arr):
         ', '.join(ret), str(column)), 'ORDER BY x.ordering'
 
 
+def gen_ordering_join(column, size, id_type='bigint'):
+    # bound ids are untyped, a prepared statement would resolve them to text
+    values_sql = ', '.join(
+        ['(%s::{}, {})'.format(id_type, x) for x in range(size)])
+    return 'JOIN (VALUES {}) AS x (id, ordering) ON {} = x.id'.format(
+        values_sql, str(column))
+
+
+def gen_ordering_query(column, arr, id_type='bigint'):
+    # like gen_ordering_sql but binds the ids, the join args go in front
+    # of the where args: select(..., args=ordering_args + args)
+    key = ('ordering', str(column), len(arr), id_type)
+    join_sql = get_cached_sql(key, gen_ordering_join, column, len(arr),
+                              id_type)
+    return join_sql, 'ORDER BY x.ordering', tuple(arr)
+
+
+def gen_group_count(table_name, columns, part_sql='', other_sql=''):
+    where_sql = f' WHERE {part_sql}' if part_sql else ''
+    other_sql = f' {other_sql} ' if other_sql else ''
+    return f'SELECT COUNT(*) FROM (SELECT {columns_to_string(columns)} ' \
+        f'FROM {get_table_name(table_name)}{where_sql}{other_sql}) G'
+
+
 @run_with_pool()
 async def group_count(cur,
                       table_name,
@@ -399,17 +1187,112 @@ async def group_count(cur,
                       part_sql='',
                       args=(),
                       other_sql=''):
-    where_sql = ' WHERE {}'.format(part_sql) if part_sql else ''
-    other_sql = ' {} '.format(other_sql) if other_sql else ''
-    sql = "SELECT COUNT(*) FROM (SELECT {} FROM {}{}{}) G".format(
-        columns_to_string(columns), get_table_name(table_name), where_sql,
-        other_sql)
+    key = ('group_count', get_table_key(table_name), get_columns_key(columns),
+           part_sql, other_sql)
+    sql = get_cached_sql(key, gen_group_count, table_name, columns, part_sql,
+                         other_sql)
     await fixed_execute(cur, sql, args)
     return await get_only_default(cur, 0)
 
 
+class PreparedStatements(object):
+
+    def __init__(self):
+        self.counts = {}
+        # sql -> statement name, least recently used first
+        self.names = {}
+        # sql the server refused to prepare, always run as is
+        self.failed = set()
+
+
+_prepared = weakref.WeakKeyDictionary()
+
+re_placeholder = re.compile('%(s|%)')
+
+
+@lru_cache(maxsize=4096)
+def to_numbered_sql(sql):
+    size = 0
+
+    def replace(m):
+        nonlocal size
+        if m.group(1) == '%':
+            return '%'
+        size += 1
+        return '${}'.format(size)
+
+    return re_placeholder.sub(replace, sql), size
+
+
+async def prepared_execute(connector, cur, sql, args):
+    stmts = _prepared.get(cur.connection)
+    if stmts is None:
+        stmts = PreparedStatements()
+        _prepared[cur.connection] = stmts
+
+    name = stmts.names.pop(sql, None)
+    if name is not None:
+        stmts.names[sql] = name
+    elif sql in stmts.failed:
+        return await cur.execute(sql, args)
+    else:
+        count = stmts.counts.get(sql, 0)
+        if count < connector.prepare_threshold:
+            if len(stmts.counts) >= connector.prepared_max:
+                stmts.counts.clear()
+            stmts.counts[sql] = count + 1
+            return await cur.execute(sql, args)
+
+        numbered_sql, size = to_numbered_sql(sql)
+        if size != len(args):
+            return await cur.execute(sql, args)
+
+        stmts.counts.pop(sql, None)
+        if len(stmts.names) >= connector.prepared_max:
+            oldest = stmts.names.pop(next(iter(stmts.names)))
+            await cur.execute('DEALLOCATE {}'.format(oldest))
+
+        name = 'p' + hashlib.blake2s(sql.encode(), digest_size=8).hexdigest()
+        try:
+            await cur.execute('PREPARE {} AS {}'.format(name, numbered_sql))
+        except PGError:
+            # PREPARE can't infer some parameter types the plain query
+            # resolves from the bound values, inside a transaction the
+            # error already aborted it and has to surface
+            status = cur.connection.raw.get_transaction_status()
+            if status != TRANSACTION_STATUS_IDLE:
+                raise
+            if len(stmts.failed) >= connector.prepared_max:
+                stmts.failed.clear()
+            stmts.failed.add(sql)
+            return await cur.execute(sql, args)
+        stmts.names[sql] = name
+
+    try:
+        return await cur.execute(
+            'EXECUTE {} ({})'.format(name, ', '.join(['%s'] * len(args))),
+            args)
+    except PGError as e:
+        # a schema change under a prepared SELECT * fails every EXECUTE
+        # with "cached plan must not change result type", drop the
+        # statement and rerun plain, it gets prepared again later. inside
+        # a transaction the error aborted it, the next idle call cleans up
+        if e.pgcode != '0A000' or \
+                cur.connection.raw.get_transaction_status() != \
+                TRANSACTION_STATUS_IDLE:
+            raise
+        stmts.names.pop(sql, None)
+        await cur.execute('DEALLOCATE {}'.format(name))
+        return await cur.execute(sql, args)
+
+
 def fixed_execute(cur, sql, args=None):
-    if args and len(args) > 0:
+    if args:
+        connector = _state_var.get().connector
+        if connector is not None and \
+                connector.prepare_threshold is not None and \
+                isinstance(args, (tuple, list)):
+            return prepared_execute(connector, cur, sql, args)
         return cur.execute(sql, args)
     else:
         return cur.execute(sql)
@@ -1,12 +1,37 @@
 from . import select_one_only, select_one, select, count as pg_count, \
-    update, insert, delete, c, cs
+    update, insert, delete, c, cs, get_placeholders, insert_many, \
+    update_many, select_stream, get_table_name, insert_or_update, \
+    acquire_cursor, insert_or_update_many, t, quote_ident
 import json
 from time import time
 import re
 import asyncio
+from contextlib import asynccontextmanager
+from functools import lru_cache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 re_op = re.compile('_(gt|lt|gte|lte)$')
 
+# table name -> {column: type name}, used to cast uniq values
+_column_types = {}
+
+
+if orjson is None:
+    json_dumps = json.dumps
+else:
+
+    def json_dumps(val):
+        try:
+            return orjson.dumps(val, option=orjson.OPT_NON_STR_KEYS).decode()
+        except TypeError:
+            # orjson refuses ints wider than 64 bits and namedtuples,
+            # keep saving whatever json.dumps accepts
+            return json.dumps(val)
+
 
 def merge_json(new, old):
     if isinstance(new, dict) and isinstance(old, dict):
@@ -79,37 +104,31 @@ async def get(table,
     return ret
 
 
-async def save(table,
-               *,
-               id=None,
-               keys=[],
-               uniq_keys=[],
-               optional_keys=[],
-               json_keys=[],
-               sub_json_keys=[],
-               replace_keys=[],
-               exclude_data_keys=[],
-               on_saved=None,
-               **data):
+_background_tasks = set()
 
-    if len(exclude_data_keys) > 0:
-        data = make_data(data.copy(), exclude_data_keys)
+# on_saved_mode and on_removed_mode:
+# 'wait'       call the callback after the write and await it
+# 'parallel'   save only, start a coroutine function callback alongside
+#              the update, cancel it if the update fails
+# 'background' call it after the write, don't wait for its coroutine
 
-    uniq_data = {}
 
-    for key in uniq_keys:
-        uniq_data[key] = data.get(key)
+async def run_callback(callback, mode, *args):
+    ret = callback(*args)
+    if not asyncio.iscoroutine(ret):
+        return
 
-    if id:
-        old = await get(table, id=id)
-        if not old:
-            raise Exception(f'update record[{id}], the record is not exists')
+    if mode == 'background':
+        # keep a reference until it is done, the loop only holds weak ones
+        task = asyncio.ensure_future(ret)
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
     else:
-        old = await get(table,
-                        uniq_keys=uniq_keys,
-                        optional_keys=optional_keys,
-                        **uniq_data)
+        await ret
+
 
+def get_changed_args(data, old, keys, json_keys, sub_json_keys,
+                     replace_keys):
     rkeys = []
     args = []
 
@@ -129,7 +148,7 @@ async def save(table,
             if old and key not in replace_keys:
                 val = merge_json(val, old[key])
             rkeys.append(key)
-            args.append(json.dumps(val))
+            args.append(json_dumps(val))
 
     for key in sub_json_keys:
         val = data.get(key)
@@ -137,7 +156,92 @@ async def save(table,
             if old:
                 val = merge_sub_json(val, old[key], replace_keys)
             rkeys.append(key)
-            args.append(json.dumps(val))
+            args.append(json_dumps(val))
+
+    return rkeys, args
+
+
+def append_insert_args(data, rkeys, args, keys, uniq_keys):
+    for key in uniq_keys:
+        val = data.get(key)
+        if val is not None:
+            rkeys.append(key)
+            args.append(val)
+
+    if 'created_at' in keys and data.get('created_at') is None:
+        rkeys.append('created_at')
+        args.append(int(time()))
+
+
+async def get_unchanged_id(table, id, uniq_keys, fingerprint, data):
+    # a stored row with the same fingerprint (etag, version, updated_at)
+    # is already up to date, nothing to merge or write
+    if id:
+        part_sql = ['id=%s']
+        args = [id]
+    else:
+        if len(uniq_keys) == 0:
+            return None
+
+        part_sql = []
+        args = []
+        for key in uniq_keys:
+            val = data.get(key)
+            if val is None:
+                return None
+            part_sql.append(f'{key}=%s')
+            args.append(val)
+
+    part_sql.append(f'{fingerprint}=%s')
+    args.append(data[fingerprint])
+
+    return await select_one_only(table, c('id'), ' AND '.join(part_sql),
+                                 tuple(args))
+
+
+async def save(table,
+               *,
+               id=None,
+               keys=[],
+               uniq_keys=[],
+               optional_keys=[],
+               json_keys=[],
+               sub_json_keys=[],
+               replace_keys=[],
+               exclude_data_keys=[],
+               on_saved=None,
+               on_saved_mode='wait',
+               fingerprint=None,
+               **data):
+
+    if len(exclude_data_keys) > 0:
+        data = make_data(data, exclude_data_keys)
+
+    if fingerprint and data.get(fingerprint) is not None:
+        oid = await get_unchanged_id(table, id, uniq_keys, fingerprint, data)
+        if oid:
+            return oid
+
+    # checked once per json key and per merged sub json item
+    replace_keys = frozenset(replace_keys)
+
+    uniq_data = {}
+
+    for key in uniq_keys:
+        uniq_data[key] = data.get(key)
+
+    if id:
+        old = await get(table, id=id)
+        if not old:
+            raise Exception(f'update record[{id}], the record is not exists')
+    else:
+        old = await get(table,
+                        uniq_keys=uniq_keys,
+                        optional_keys=optional_keys,
+                        **uniq_data)
+
+    rkeys, args = get_changed_args(data, old, keys, json_keys, sub_json_keys,
+                                   replace_keys)
 
     if old:
         uniq_changed = False
@@ -151,57 +255,301 @@ async def save(table,
                 args.append(val)
                 uniq_changed = True
 
-        if uniq_changed:
-            old1 = await get(table,
-                             uniq_keys=uniq_keys,
-                             optional_keys=optional_keys,
-                             **uniq_data)
-            if old1:
-                oid = old1['id']
-                err = f'cant update record uniq value to exists value {oid}'
-                raise Exception(err)
-
         if len(args) == 0:
             return old['id']
 
         args.append(old['id'])
-        await update(table, cs(rkeys), 'id=%s', tuple(args))
+        part_sql = 'id=%s'
 
-        if on_saved:
-            ret = on_saved(old, old['id'])
-            if asyncio.iscoroutine(ret):
-                await ret
-        return old['id']
-    else:
-        for key in uniq_keys:
-            val = data.get(key)
-            if val is not None:
-                rkeys.append(key)
+        if uniq_changed:
+            # let the update itself refuse to take over another record's
+            # uniq value instead of looking for one first
+            uniq_sql = []
+            for key in uniq_keys:
+                val = uniq_data[key]
+                if val is None:
+                    if key in optional_keys:
+                        continue
+                    raise Exception(f'{key} is required')
+                uniq_sql.append(f'{key}=%s')
                 args.append(val)
 
-        if 'created_at' in keys and data.get('created_at') is None:
-            rkeys.append('created_at')
-            args.append(int(time()))
+            uniq_sql = ' AND '.join(uniq_sql)
+            part_sql = f'id=%s AND NOT EXISTS ' \
+                f'(SELECT 1 FROM {get_table_name(table)} WHERE {uniq_sql})'
+
+        task = None
+        if on_saved and on_saved_mode == 'parallel' and \
+                asyncio.iscoroutinefunction(on_saved):
+            # the callback only gets the old row, let it overlap the
+            # update, only for side effects that don't read the row back
+            # (a cache filled meanwhile would keep the old value)
+            task = asyncio.ensure_future(on_saved(old, old['id']))
+
+        try:
+            rowcount = await update(table, cs(rkeys), part_sql, tuple(args))
+
+            if uniq_changed and rowcount == 0:
+                old1 = await get(table,
+                                 uniq_keys=uniq_keys,
+                                 optional_keys=optional_keys,
+                                 **uniq_data)
+                oid = old1['id'] if old1 else None
+                err = f'cant update record uniq value to exists value {oid}'
+                raise Exception(err)
+        except BaseException:
+            if task is not None:
+                task.cancel()
+            raise
+
+        if task is not None:
+            await task
+        elif on_saved:
+            await run_callback(on_saved, on_saved_mode, old, old['id'])
+        return old['id']
+    else:
+        append_insert_args(data, rkeys, args, keys, uniq_keys)
 
         nid = await insert(table, cs(rkeys), tuple(args), c('id'))
         if on_saved:
-            ret = on_saved(None, nid)
-            if asyncio.iscoroutine(ret):
-                await ret
+            await run_callback(on_saved, on_saved_mode, None, nid)
 
         return nid
 
 
-async def remove(table, *args, on_removed=None, **kwargs):
+async def save_upsert(table, *, keys=[], uniq_keys=[], json_keys=[], **data):
+    # one INSERT ... ON CONFLICT round trip instead of get + write, needs a
+    # unique index on uniq_keys, json values replace the stored ones
+    if len(uniq_keys) == 0:
+        raise Exception('uniq_keys is required')
+
+    uniq_args = []
+    for key in uniq_keys:
+        val = data.get(key)
+        if val is None:
+            raise Exception(f'{key} is required')
+        uniq_args.append(val)
+
+    rkeys, args = get_changed_args(data, None, keys, json_keys, [], ())
+
+    other_keys = []
+    other_args = []
+    if 'created_at' in keys and data.get('created_at') is None:
+        other_keys.append('created_at')
+        other_args.append(int(time()))
+
+    nid = await insert_or_update(table,
+                                 cs(uniq_keys),
+                                 cs(rkeys),
+                                 cs(other_keys),
+                                 tuple(uniq_args + args + other_args),
+                                 ret_column=c('id'))
+    if nid is None:
+        # nothing to update, DO NOTHING returns no row for an existing one
+        part_sql = ' AND '.join([f'{key}=%s' for key in uniq_keys])
+        nid = await select_one_only(table, c('id'), part_sql,
+                                    tuple(uniq_args))
+
+    return nid
+
+
+async def get_column_types(table, keys, cur=None):
+    types = _column_types.get(table.table_name)
+    if types is None or any([key not in types for key in keys]):
+        rows = await select(t('pg_attribute'),
+                            cs(['attname', 'format_type(atttypid, NULL)']),
+                            'attrelid=%s::regclass AND attnum > 0',
+                            (quote_ident(table.table_name), ),
+                            cur=cur,
+                            as_dict=False)
+        types = {x[0]: x[1] for x in rows}
+        _column_types[table.table_name] = types
+
+    return [types[key] for key in keys]
+
+
+async def get_many_by_uniq(table,
+                           uniq_keys,
+                           uniqs,
+                           page_size=1000,
+                           cur=None):
+    # returns {index in uniqs: row}, the values are cast to the column
+    # types on the server, so '2024-01-01' finds a date key and 1 a
+    # numeric one just like the WHERE in get does
+    types = await get_column_types(table, uniq_keys, cur)
+    v = ', '.join([f'%s::{tp}' for tp in types])
+    names = ', '.join([f'k{i}' for i in range(len(uniq_keys))])
+    on_sql = ' AND '.join(
+        [f'o.{key}=x.k{i}' for i, key in enumerate(uniq_keys)])
+    olds = {}
+    for i in range(0, len(uniqs), page_size):
+        page = uniqs[i:i + page_size]
+        values_sql = ', '.join([f'({v}, {idx})' for idx in range(len(page))])
+        join_sql = f'JOIN (VALUES {values_sql}) AS x ({names}, idx) ' \
+            f'ON {on_sql}'
+        args = tuple([x for uniq in page for x in uniq])
+        rows = await select(table.alias('o'),
+                            cs(['x.idx AS "__idx"', 'o.*']),
+                            args=args,
+                            join_sql=join_sql,
+                            cur=cur)
+        for old in rows:
+            old = dict(old)
+            olds[i + old.pop('__idx')] = old
+
+    return olds
+
+
+def get_uniqs(rows, uniq_keys):
+    if len(uniq_keys) == 0:
+        raise Exception('uniq_keys is required')
+
+    uniqs = []
+    for data in rows:
+        uniq = tuple([data.get(key) for key in uniq_keys])
+        for key, val in zip(uniq_keys, uniq):
+            if val is None:
+                raise Exception(f'{key} is required')
+        uniqs.append(uniq)
+
+    if len(set(uniqs)) < len(uniqs):
+        raise Exception('got the same uniq value twice')
+
+    return uniqs
+
+
+async def save_many(table,
+                    rows,
+                    *,
+                    keys=[],
+                    uniq_keys=[],
+                    json_keys=[],
+                    sub_json_keys=[],
+                    replace_keys=[],
+                    page_size=1000,
+                    cur=None):
+    # one select for the existing rows, then one statement per page for
+    # each shape of insert or update, returns the ids in row order
+    replace_keys = frozenset(replace_keys)
+    uniqs = get_uniqs(rows, uniq_keys)
+
+    olds = await get_many_by_uniq(table, uniq_keys, uniqs, page_size, cur)
+
+    ids = [None] * len(rows)
+    inserts = {}
+    updates = {}
+    for idx, data in enumerate(rows):
+        old = olds.get(idx)
+        rkeys, args = get_changed_args(data, old, keys, json_keys,
+                                       sub_json_keys, replace_keys)
+        if old:
+            ids[idx] = old['id']
+            if len(args) > 0:
+                args.append(old['id'])
+                updates.setdefault(tuple(rkeys), []).append(args)
+        else:
+            append_insert_args(data, rkeys, args, keys, uniq_keys)
+            idxs, new_rows = inserts.setdefault(tuple(rkeys), ([], []))
+            idxs.append(idx)
+            new_rows.append(args)
+
+    new_idxs = []
+    for rkeys, (idxs, new_rows) in inserts.items():
+        await insert_many(table,
+                          cs(rkeys),
+                          new_rows,
+                          page_size=page_size,
+                          cur=cur)
+        new_idxs.extend(idxs)
+
+    if new_idxs:
+        # RETURNING rows don't have to follow the VALUES order, look the
+        # new ids up by their uniq values instead
+        news = await get_many_by_uniq(table, uniq_keys,
+                                      [uniqs[idx] for idx in new_idxs],
+                                      page_size, cur)
+        for i, idx in enumerate(new_idxs):
+            ids[idx] = news[i]['id']
+
+    for rkeys, new_rows in updates.items():
+        await update_many(table,
+                          cs(rkeys),
+                          'id=%s',
+                          new_rows,
+                          page_size=page_size,
+                          cur=cur)
+
+    return ids
+
+
+async def save_upsert_many(table,
+                           rows,
+                           *,
+                           keys=[],
+                           uniq_keys=[],
+                           json_keys=[],
+                           page_size=1000,
+                           cur=None):
+    # save_upsert for many rows, one multi-row INSERT ... ON CONFLICT per
+    # page and column shape, returns the ids in row order
+    uniqs = get_uniqs(rows, uniq_keys)
+    now = int(time())
+
+    groups = {}
+    for data, uniq in zip(rows, uniqs):
+        rkeys, args = get_changed_args(data, None, keys, json_keys, [], ())
+        other_keys = []
+        if 'created_at' in keys and data.get('created_at') is None:
+            other_keys.append('created_at')
+            args.append(now)
+
+        groups.setdefault((tuple(rkeys), tuple(other_keys)),
+                          []).append(list(uniq) + args)
+
+    for (rkeys, other_keys), new_rows in groups.items():
+        await insert_or_update_many(table,
+                                    cs(uniq_keys),
+                                    cs(rkeys),
+                                    cs(other_keys),
+                                    new_rows,
+                                    page_size=page_size,
+                                    cur=cur)
+
+    # DO NOTHING returns no row for existing records and RETURNING rows
+    # don't have to follow the VALUES order, look all ids up afterwards
+    olds = await get_many_by_uniq(table, uniq_keys, uniqs, page_size, cur)
+    return [olds[idx]['id'] for idx in range(len(rows))]
+
+
+@asynccontextmanager
+async def bulk_save_session():
+    # one transaction that commits without waiting for the WAL flush, a
+    # crash may lose the last commits but never corrupts, e.g.
+    # async with bulk_save_session() as cur:
+    #     await save_many(table, rows, ..., cur=cur)
+    async with acquire_cursor(cursor_factory=None) as cur:
+        await cur.execute('BEGIN')
+        try:
+            await cur.execute('SET LOCAL synchronous_commit = off')
+            yield cur
+        except BaseException:
+            await cur.execute('ROLLBACK')
+            raise
+        await cur.execute('COMMIT')
+
+
+async def remove(table,
+                 *args,
+                 on_removed=None,
+                 on_removed_mode='wait',
+                 **kwargs):
     fields = ['*'] if on_removed else ['id']
 
     old = await get(table, *args, fields=fields, **kwargs)
     if old:
         await delete(table, 'id=%s', (old['id'], ))
         if on_removed:
-            ret = on_removed(old)
-            if asyncio.iscoroutine(ret):
-                await ret
+            await run_callback(on_removed, on_removed_mode, old)
 
         return True
     return False
@@ -210,57 +558,62 @@ async def remove(table, *args, on_removed=None, **kwargs):
 op_map = {'gt': '>', 'lt': '<', 'lte': '<=', 'gte': '>='}
 
 
+@lru_cache(maxsize=1024)
+def parse_key(key):
+    m = re_op.search(key)
+    if m is None:
+        return key, '='
+
+    op = m.group(1)
+    return key[:-len(op) - 1], op_map[op]
+
+
 def append_query(query, key, val):
     if val is None:
         return
 
     if isinstance(val, list):
-        vs = ['%s' for x in val]
-        query.append((key, f'{key} in (' + ', '.join(vs) + ')', val))
+        query.append((key, f'{key} in ({get_placeholders(len(val))})', val))
         return
 
-    m = re_op.search(key)
-
-    op = '='
-    if m:
-        op = m.group(1)
-        key = key[:-len(op) - 1]
-        op = op_map[op]
-
+    key, op = parse_key(key)
     query.append((key, f'{key}{op}%s', val))
 
 
 def sort_query(query, sort_keys):
-    ret = []
-    for key in sort_keys:
-        other = []
-        for q in query:
-            if q[0] == key:
-                ret.append(q)
-            else:
-                other.append(q)
+    if not sort_keys:
+        return query
 
-        query = other
+    groups = {key: [] for key in sort_keys}
+    other = []
+    for q in query:
+        group = groups.get(q[0])
+        if group is None:
+            other.append(q)
+        else:
+            group.append(q)
 
-    return ret + query
+    ret = []
+    for group in groups.values():
+        ret.extend(group)
+
+    return ret + other
 
 
 def record_query_to_sql(query, part_sql='', args=()):
-    new_part_sql = []
+    new_part_sql = [q[1] for q in query]
     new_args = []
     for q in query:
-        new_part_sql.append(q[1])
         if isinstance(q[2], list):
-            new_args += q[2]
+            new_args.extend(q[2])
         else:
             new_args.append(q[2])
 
     if part_sql:
         new_part_sql.append(part_sql)
 
-    if len(args) > 0:
-        for arg in args:
-            new_args.append(arg)
+    if args:
+        new_args.extend(args)
 
     return ' AND '.join(new_part_sql), tuple(new_args)
 
@@ -306,11 +659,69 @@ async def get_list(table,
                        other_sql=other_sql)
 
     if popup:
-        return [popup_data(v) for v in ret]
+        return list(map(popup_data, ret))
 
     return ret
 
 
+async def count_and_list(table,
+                         *args,
+                         offset=None,
+                         size=None,
+                         fields=['*'],
+                         popup=False,
+                         field='*',
+                         join_sql='',
+                         other_sql='order by id desc',
+                         **kwargs):
+    # builds the filter once and runs the total and the page side by side,
+    # other_sql only applies to the page
+    part_sql, args = gen_query(*args, **kwargs)
+    total, ret = await asyncio.gather(
+        pg_count(table, part_sql, args, column=c(field), join_sql=join_sql),
+        select(table,
+               cs(fields),
+               part_sql,
+               args,
+               offset=offset,
+               size=size,
+               join_sql=join_sql,
+               other_sql=other_sql))
+
+    if popup:
+        ret = list(map(popup_data, ret))
+
+    return total, ret
+
+
+async def iter_list(table,
+                    *args,
+                    fields=['*'],
+                    popup=False,
+                    join_sql='',
+                    other_sql='order by id desc',
+                    chunk_size=1000,
+                    **kwargs):
+
+    part_sql, args = gen_query(*args, **kwargs)
+    stream = select_stream(table,
+                           cs(fields),
+                           part_sql,
+                           args,
+                           other_sql=other_sql,
+                           join_sql=join_sql,
+                           chunk_size=chunk_size)
+    # closing iter_list must release the stream's connection right away
+    try:
+        async for row in stream:
+            if popup:
+                yield popup_data(row)
+            else:
+                yield row
+    finally:
+        await stream.aclose()
+
+
 def popup_data(ret):
     if isinstance(ret, dict):
         data = ret.pop('data', None)
@@ -326,9 +737,10 @@ def make_data(data, exclude_data_keys=[]):
     new = {}
 
     for k in exclude_data_keys:
-        v = data.pop(k, None)
+        v = data.get(k)
         if v is not None:
             new[k] = v
 
-    new['data'] = data
+    excluded = frozenset(exclude_data_keys)
+    new['data'] = {k: v for k, v in data.items() if k not in excluded}
     return new
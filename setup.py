@@ -18,4 +18,8 @@ setup(
     package_dir={'psql_utils': 'psql_utils'},
     include_package_data=True,
     install_requires=requires,
+    extras_require={
+        'asyncpg': ['asyncpg'],
+        'orjson': ['orjson'],
+    },
 )
@@ -0,0 +1,161 @@
+import asyncio
+import datetime
+import os
+
+import pytest
+
+pytest.importorskip('aiopg')
+
+import psql_utils  # noqa: E402
+from psql_utils import t, cs, record  # noqa: E402
+
+DSN = os.environ.get('PSQL_UTILS_TEST_DSN')
+
+pytestmark = pytest.mark.skipif(DSN is None,
+                                reason='PSQL_UTILS_TEST_DSN is not set')
+
+table = t('psql_utils_test_many')
+
+
+def run(coro, driver='aiopg'):
+
+    async def main():
+        await psql_utils.connect({'dsn': DSN, 'driver': driver})
+        try:
+            await psql_utils.create_table(
+                table,
+                cs([
+                    'id BIGSERIAL PRIMARY KEY', 'day date NOT NULL',
+                    'num numeric NOT NULL', 'v int', 'created_at int',
+                    'UNIQUE (day, num)'
+                ]))
+            await psql_utils.delete(table)
+            return await coro()
+        finally:
+            await psql_utils.drop_table(table)
+            await psql_utils.close()
+
+    return asyncio.run(main())
+
+
+async def get_ids():
+    rows = await psql_utils.select(table, cs(['id', 'day', 'num', 'v']))
+    return {(str(x['day']), int(x['num'])): x for x in rows}
+
+
+def make_rows(size, v=0):
+    return [{
+        'day': f'2024-01-{x % 28 + 1:02d}',
+        'num': x,
+        'v': x + v
+    } for x in range(size)]
+
+
+def test_save_many_maps_ids_by_uniq_values():
+
+    async def main():
+        rows = make_rows(10)
+        ids = await record.save_many(table,
+                                     rows[:6],
+                                     keys=['v', 'created_at'],
+                                     uniq_keys=['day', 'num'],
+                                     page_size=4)
+        # strings for a date key and ints for a numeric key find the
+        # stored rows, the first six update, the rest insert
+        ids2 = await record.save_many(table,
+                                      make_rows(10, v=100),
+                                      keys=['v', 'created_at'],
+                                      uniq_keys=['day', 'num'],
+                                      page_size=4)
+        stored = await get_ids()
+        return rows, ids, ids2, stored
+
+    rows, ids, ids2, stored = run(main)
+    assert len(stored) == 10
+    for data, id0, id1 in zip(rows, ids + [None] * 4, ids2):
+        row = stored[(data['day'], data['num'])]
+        assert row['id'] == id1
+        assert row['v'] == data['v'] + 100
+        if id0 is not None:
+            assert id0 == id1
+
+
+def test_save_many_accepts_typed_values():
+
+    async def main():
+        rows = [{
+            'day': datetime.date(2024, 2, x + 1),
+            'num': x,
+            'v': x
+        } for x in range(5)]
+        ids = await record.save_many(table,
+                                     rows,
+                                     keys=['v'],
+                                     uniq_keys=['day', 'num'],
+                                     page_size=2)
+        return rows, ids, await get_ids()
+
+    rows, ids, stored = run(main)
+    for data, nid in zip(rows, ids):
+        assert stored[(str(data['day']), data['num'])]['id'] == nid
+
+
+def test_save_upsert_many_maps_ids_by_uniq_values():
+
+    async def main():
+        rows = make_rows(8)
+        ids = await record.save_upsert_many(table,
+                                            rows[:5],
+                                            keys=['v', 'created_at'],
+                                            uniq_keys=['day', 'num'],
+                                            page_size=3)
+        ids2 = await record.save_upsert_many(table,
+                                             make_rows(8, v=50),
+                                             keys=['v', 'created_at'],
+                                             uniq_keys=['day', 'num'],
+                                             page_size=3)
+        # no value keys, existing rows are left alone and still found
+        ids3 = await record.save_upsert_many(
+            table, [{
+                'day': x['day'],
+                'num': x['num']
+            } for x in rows],
+            keys=['created_at'],
+            uniq_keys=['day', 'num'],
+            page_size=3)
+        return rows, ids, ids2, ids3, await get_ids()
+
+    rows, ids, ids2, ids3, stored = run(main)
+    assert ids == ids2[:5]
+    assert ids2 == ids3
+    for data, nid in zip(rows, ids2):
+        row = stored[(data['day'], data['num'])]
+        assert row['id'] == nid
+        assert row['v'] == data['v'] + 50
+
+
+def test_save_many_asyncpg():
+    pytest.importorskip('asyncpg')
+
+    async def main():
+        rows = [{
+            'day': datetime.date(2024, 3, x + 1),
+            'num': x,
+            'v': x
+        } for x in range(6)]
+        ids = await record.save_many(table,
+                                     rows[:3],
+                                     keys=['v'],
+                                     uniq_keys=['day', 'num'],
+                                     page_size=2)
+        ids2 = await record.save_upsert_many(table,
+                                             rows,
+                                             keys=['v'],
+                                             uniq_keys=['day', 'num'],
+                                             page_size=2)
+        return rows, ids, ids2, await get_ids()
+
+    rows, ids, ids2, stored = run(main, 'asyncpg')
+    assert ids == ids2[:3]
+    for data, nid in zip(rows, ids2):
+        assert stored[(str(data['day']), data['num'])]['id'] == nid